@@ -1,80 +1,302 @@
 from __future__ import annotations
-from typing import Iterator, Mapping, Optional, Tuple
+from collections import OrderedDict
+from typing import Iterator, Optional, Sequence, Tuple
 import math
-import time
-from enum import Enum
+
+import numpy as np
+from numba import njit
 
 Point = Tuple[int, int]
 
-CARDINALS: list[Point] = [(0, -1), (-1, 0), (1, 0), (0, 1)]
-DIAGONALS: list[Point] = [(-1, -1), (1, -1), (-1, 1), (1, 1)]
-ADJACENTS: list[Point] = [
+CARDINALS: tuple[Point, ...] = ((0, -1), (-1, 0), (1, 0), (0, 1))
+DIAGONALS: tuple[Point, ...] = ((-1, -1), (1, -1), (-1, 1), (1, 1))
+ADJACENTS: tuple[Point, ...] = (
     DIAGONALS[0], CARDINALS[0], DIAGONALS[1],
     *CARDINALS[1:3],
     DIAGONALS[2], CARDINALS[3], DIAGONALS[3],
-]
+)
+
+SQRT2 = math.sqrt(2)
+_SQRT2_MINUS_2 = SQRT2 - 2
+# how many goals Grid keeps a precomputed heuristic for
+_HEURISTIC_CACHE_SIZE = 4
+
+# the compiled search buckets f-costs in steps of 1 / _COST_SCALE
+_COST_SCALE = 1000
 
-class Directions(Enum):
-    adjacent = ADJACENTS
-    cardinals = CARDINALS
-    diagonals = DIAGONALS
+# bits of Grid.status
+WALL = 1
+CLOSED = 2
 
 
 class Node:
+    # Grids create at most one Node per cell, so the default identity based
+    # __eq__/__hash__ are used for set membership
+    __slots__ = ('value', 'x', 'y')
+
     def __init__(self, value, x, y):
         self.value =  value
         self.x = x
         self.y = y
-        self.parent: Optional[Node] = None
-        self.cost = float('inf')
 
     def __repr__(self):
         return f"<Node value={self.value} position=({self.x}, {self.y})>"
 
-    def __eq__(self, other) -> bool:
-        if not isinstance(other, Node):
-            raise NotImplemented
-        return self.position == other.position
-
-    def __hash__(self) -> int:
-        return hash(self.position)
-
     @property
     def position(self) -> Point:
         return (self.x, self.y)
 
 
-class Grid(Mapping):
-    def __init__(self, nodes: list[Node], width: int, height: int):
-        self.nodes = nodes
-        self.width = width
-        self.height = height
+# ADJACENTS split into arrays so the compiled search can index them
+_ADJ_DX = np.array([point[0] for point in ADJACENTS], dtype=np.int64)
+_ADJ_DY = np.array([point[1] for point in ADJACENTS], dtype=np.int64)
+
+
+@njit(cache=True)
+def _octile(x: int, y: int, gx: int, gy: int) -> float:
+    dx = abs(x - gx)
+    dy = abs(y - gy)
+    return (dx + dy) + _SQRT2_MINUS_2 * min(dx, dy)
+
+
+@njit(cache=True)
+def _blocked(status: np.ndarray, w: int, h: int, x: int, y: int) -> bool:
+    return not (0 <= x < w and 0 <= y < h) or status[x + w*y] & WALL != 0
+
+
+@njit(cache=True)
+def _jump_straight(status: np.ndarray, w: int, h: int, x: int, y: int, dx: int, dy: int, goal: int) -> int:
+    '''
+    Walks from (x, y) along a cardinal direction and returns the index of
+    the first jump point, or -1 if a wall or the edge is hit first
+    '''
+    while True:
+        x += dx
+        y += dy
+        if _blocked(status, w, h, x, y):
+            return -1
+        index = x + w*y
+        if index == goal:
+            return index
+        if dx:
+            if (_blocked(status, w, h, x, y + 1) and not _blocked(status, w, h, x + dx, y + 1)) or \
+               (_blocked(status, w, h, x, y - 1) and not _blocked(status, w, h, x + dx, y - 1)):
+                return index
+        else:
+            if (_blocked(status, w, h, x + 1, y) and not _blocked(status, w, h, x + 1, y + dy)) or \
+               (_blocked(status, w, h, x - 1, y) and not _blocked(status, w, h, x - 1, y + dy)):
+                return index
+
+
+@njit(cache=True)
+def _jump(status: np.ndarray, w: int, h: int, x: int, y: int, dx: int, dy: int, goal: int) -> int:
+    '''
+    Returns the index of the jump point reached from (x, y) in direction
+    (dx, dy), or -1 if there is none
+    '''
+    if not (dx and dy):
+        return _jump_straight(status, w, h, x, y, dx, dy, goal)
+    while True:
+        x += dx
+        y += dy
+        if _blocked(status, w, h, x, y):
+            return -1
+        index = x + w*y
+        if index == goal:
+            return index
+        if (_blocked(status, w, h, x - dx, y) and not _blocked(status, w, h, x - dx, y + dy)) or \
+           (_blocked(status, w, h, x, y - dy) and not _blocked(status, w, h, x + dx, y - dy)):
+            return index
+        if _jump_straight(status, w, h, x, y, dx, 0, goal) != -1 or \
+           _jump_straight(status, w, h, x, y, 0, dy, goal) != -1:
+            return index
+
+
+@njit(cache=True)
+def _astar_numba(
+    status: np.ndarray, heuristic: np.ndarray, cost: np.ndarray, parent: np.ndarray,
+    w: int, h: int, sx: int, sy: int, gx: int, gy: int,
+):
+    '''
+    Jump point search over a flat grid of WALL / CLOSED status bits,
+    indexed as x + w*y, with heuristic holding the distance from every cell
+    to the goal
+
+    cost and parent must come in cleared (inf and -1) and status without
+    CLOSED bits. They are filled with the g-cost and the parent jump point
+    of every reached cell and the CLOSED bit of every expanded one, the
+    goal was reached if it is closed
+
+    The open list is a bucket queue indexed by the f-cost scaled by
+    _COST_SCALE and rounded down, g-costs themselves stay exact. Entries
+    within a bucket come out in no particular order, so a closed node is
+    opened again when a cheaper way to it turns up, and the search only
+    stops once the buckets are past the goal's cost. The heuristic is
+    consistent, so the lowest f-cost never decreases and every open entry
+    lies within twice the longest jump of it, which bounds the ring of
+    buckets that is needed
+    '''
+    longest_jump = max(max(w, h) - 1, SQRT2 * (min(w, h) - 1))
+    n_buckets = int(2 * longest_jump * _COST_SCALE) + 2
+    # each bucket is a linked list of entries, threaded through entry_next
+    bucket_head = np.full(n_buckets, -1, np.int32)
+    entry_next = np.empty(w * h, np.int32)
+    entry_node = np.empty(w * h, np.int32)
+    # directions to jump in from the node being expanded
+    dirs_x = np.empty(8, np.int64)
+    dirs_y = np.empty(8, np.int64)
+
+    start = sx + w*sy
+    goal = gx + w*gy
+    cost[start] = 0.0
+    current = int(heuristic[start] * _COST_SCALE)
+    bucket_head[current % n_buckets] = 0
+    entry_next[0] = -1
+    entry_node[0] = start
+    entries = 1
+    queued = 1
+    # bucket of the goal's latest entry, nothing after it can improve on it
+    goal_bucket = current if start == goal else np.iinfo(np.int64).max
+    while queued:
+        while bucket_head[current % n_buckets] == -1:
+            current += 1
+        if current > goal_bucket:
+            break
+        entry = bucket_head[current % n_buckets]
+        bucket_head[current % n_buckets] = entry_next[entry]
+        queued -= 1
+        visiting = entry_node[entry]
+        # stale entries are left in the buckets and skipped here
+        if status[visiting] & CLOSED:
+            continue
+        status[visiting] |= CLOSED
+        if visiting == goal:
+            continue
+        x = visiting % w
+        y = visiting // w
+
+        # prune the directions to the natural and forced neighbours
+        # of the direction the node was reached from
+        count = 0
+        if parent[visiting] == -1:
+            for d in range(_ADJ_DX.shape[0]):
+                dirs_x[count], dirs_y[count] = _ADJ_DX[d], _ADJ_DY[d]
+                count += 1
+        else:
+            dx = np.sign(x - parent[visiting] % w)
+            dy = np.sign(y - parent[visiting] // w)
+            if dx and dy:
+                dirs_x[0], dirs_y[0] = dx, 0
+                dirs_x[1], dirs_y[1] = 0, dy
+                dirs_x[2], dirs_y[2] = dx, dy
+                count = 3
+                if _blocked(status, w, h, x - dx, y):
+                    dirs_x[count], dirs_y[count] = -dx, dy
+                    count += 1
+                if _blocked(status, w, h, x, y - dy):
+                    dirs_x[count], dirs_y[count] = dx, -dy
+                    count += 1
+            elif dx:
+                dirs_x[0], dirs_y[0] = dx, 0
+                count = 1
+                for side in (-1, 1):
+                    if _blocked(status, w, h, x, y + side):
+                        dirs_x[count], dirs_y[count] = dx, side
+                        count += 1
+            else:
+                dirs_x[0], dirs_y[0] = 0, dy
+                count = 1
+                for side in (-1, 1):
+                    if _blocked(status, w, h, x + side, y):
+                        dirs_x[count], dirs_y[count] = side, dy
+                        count += 1
+
+        for d in range(count):
+            node = _jump(status, w, h, x, y, dirs_x[d], dirs_y[d], goal)
+            if node == -1:
+                continue
+            nx = node % w
+            ny = node // w
+            g_cost = cost[visiting] + _octile(x, y, nx, ny)
+            if cost[node] <= g_cost:
+                continue
+            cost[node] = g_cost
+            parent[node] = visiting
+            # a closed node reached more cheaply is expanded again
+            status[node] &= ~CLOSED
+            if entries == entry_node.shape[0]:
+                entry_next = np.concatenate((entry_next, np.empty(entries, np.int32)))
+                entry_node = np.concatenate((entry_node, np.empty(entries, np.int32)))
+            # rounding can put f a hair below the current bucket
+            key = max(current, int((g_cost + heuristic[node]) * _COST_SCALE))
+            if node == goal:
+                goal_bucket = key
+            bucket = key % n_buckets
+            entry_next[entries] = bucket_head[bucket]
+            entry_node[entries] = node
+            bucket_head[bucket] = entries
+            entries += 1
+            queued += 1
+
+
+class Grid:
+    def __init__(self, cells: np.ndarray):
+        # (height, width) array of the code point of every cell
+        self.cells = cells
+        self.height, self.width = cells.shape
+        # (height, width) array of WALL and CLOSED bits
+        self.status = (cells == ord('#')).astype(np.uint8) * WALL
+        # flat index offsets of the direction sets, only valid away from
+        # the edge of the grid where no bounds check is needed
+        self._cardinal_deltas = tuple(dx + self.width*dy for dx, dy in CARDINALS)
+        self._diagonal_deltas = tuple(dx + self.width*dy for dx, dy in DIAGONALS)
+        self._adj_deltas = tuple(dx + self.width*dy for dx, dy in ADJACENTS)
+        # Nodes are only created once they are asked for, keyed by index
+        self.nodes: dict[int, Node] = {}
+        # parent index and g-cost of every cell from the last search
+        self.parent_idx = np.full(cells.size, -1, np.int32)
+        self.cost_arr = np.full(cells.size, np.inf)
+        # most recently used goals and their heuristic arrays
+        self._heuristics: OrderedDict[Point, np.ndarray] = OrderedDict()
 
     def __repr__(self):
         ret = ""
-        for y in range(self.height):
-            for x in range(self.width):
-                ret += self[(x, y)].value
+        for row in self.cells:
+            ret += ''.join(map(chr, row))
             ret += '\n'
         return ret
 
     @classmethod
     def from_text(cls, text: str):
-        nodes, width, height = [], 0, 0
-        for y, line in enumerate(text.strip().splitlines()):
-            height += 1
-            width = len(line.strip())
-            for x, value in enumerate(line.strip()):
-                nodes.append(Node(value, x, y))
-        return cls(nodes=nodes, width=width, height=height)
+        lines = [line.strip() for line in text.strip().splitlines()]
+        width = len(lines[0]) if lines else 0
+        for y, line in enumerate(lines):
+            if len(line) != width:
+                raise ValueError(
+                    f"row {y} is {len(line)} characters wide, expected {width}: {line!r}"
+                )
+        cells = np.frombuffer(
+            ''.join(lines).encode('utf-32-le'), dtype='<u4',
+        ).reshape(len(lines), width)
+        return cls(cells)
+
+    def _node(self, index: int) -> Node:
+        node = self.nodes.get(index)
+        if node is None:
+            y, x = divmod(index, self.width)
+            node = self.nodes[index] = Node(chr(self.cells[y, x]), x, y)
+        return node
+
+    def _at(self, x: int, y: int) -> Optional[Node]:
+        if 0 <= x < self.width and 0 <= y < self.height:
+            return self._node(x + self.width*y)
+        return None
 
     def __getitem__(self, key: Point) -> Node:
-        x, y = key
-        index = x + self.width * y
-        try:
-            return self.nodes[index]
-        except IndexError:
-            raise KeyError
+        node = self._at(*key)
+        if node is None:
+            raise KeyError(key)
+        return node
 
     def __iter__(self) -> Iterator[Point]:
         for y in range(self.height):
@@ -82,103 +304,130 @@ class Grid(Mapping):
                 yield (x, y)
 
     def __len__(self):
-        return len(self.nodes)
-
-
-    def neighbours(self, node: Node, directions: Directions) -> Iterator[Node]:
-        points = []
-        for point in directions.value:
-            x, y = point
-            x, y = node.x+x, node.y+y
-            if x<0 or y<0:
-                pass
-            else:
-                points.append(self.get((x, y), None))
-        return filter(None, points)
+        return self.cells.size
+
+
+    def neighbours(self, node: Node, directions: Sequence[Point]) -> Iterator[Node]:
+        w, h = self.width, self.height
+        x0, y0 = node.x, node.y
+        if directions is ADJACENTS:
+            deltas = self._adj_deltas
+        elif directions is CARDINALS:
+            deltas = self._cardinal_deltas
+        elif directions is DIAGONALS:
+            deltas = self._diagonal_deltas
+        else:
+            deltas = None
+        if deltas is not None and 0 < x0 < w-1 and 0 < y0 < h-1:
+            index = x0 + w*y0
+            for delta in deltas:
+                yield self._node(index + delta)
+            return
+        for dx, dy in directions:
+            neighbour = self._at(x0+dx, y0+dy)
+            if neighbour is not None:
+                yield neighbour
 
 
     def cardinals(self, node: Node) -> Iterator[Node]:
-        return self.neighbours(node, Directions.cardinals)
+        return self.neighbours(node, CARDINALS)
 
     def diagonals(self, node: Node) -> Iterator[Node]:
-        return self.neighbours(node, Directions.diagonals)
+        return self.neighbours(node, DIAGONALS)
 
     def adjacent(self, node: Node) -> Iterator[Node]:
-        return self.neighbours(node, Directions.adjacent)
+        return self.neighbours(node, ADJACENTS)
 
     @staticmethod
     def distance(a: Node, b: Node) -> float:
-        return math.sqrt((a.x-b.x)**2 + (a.y-b.y)**2)
+        '''
+        Returns the octile distance between a and b, the exact path length
+        on an open 8-connected grid
+        '''
+        dx = abs(a.x - b.x)
+        dy = abs(a.y - b.y)
+        return (dx + dy) + _SQRT2_MINUS_2 * min(dx, dy)
+
+    def _precompute_heuristic(self, gx: int, gy: int) -> np.ndarray:
+        '''
+        Returns the octile distance from every cell to (gx, gy) as a flat
+        array indexed by x + width*y
+        '''
+        heuristic = self._heuristics.get((gx, gy))
+        if heuristic is not None:
+            self._heuristics.move_to_end((gx, gy))
+            return heuristic
+        X, Y = np.meshgrid(np.arange(self.width), np.arange(self.height))
+        dx = np.abs(X - gx)
+        dy = np.abs(Y - gy)
+        heuristic = ((dx + dy) + _SQRT2_MINUS_2 * np.minimum(dx, dy)).ravel()
+        self._heuristics[(gx, gy)] = heuristic
+        if len(self._heuristics) > _HEURISTIC_CACHE_SIZE:
+            self._heuristics.popitem(last=False)
+        return heuristic
 
     def traversable(self, node: Node) -> bool:
-        return node.value != '#'
+        return self.status[node.y, node.x] & WALL == 0
 
     def clear_nodes(self):
-        for node in self.nodes:
-            node.parent = None
-            node.cost = float('inf')
+        self.parent_idx.fill(-1)
+        self.cost_arr.fill(np.inf)
+        self.status &= WALL
 
-    def astar(self, start: Node, goal: Node) -> list[Node]:
+    def _render_state(self, path: list[Node]):
+        '''
+        Prints the grid with the path, closed and open nodes of a search
+        highlighted
+        '''
+        on_path = {node.x + self.width * node.y for node in path}
+        ret = ""
+        for y in range(self.height):
+            for x in range(self.width):
+                index = x + self.width * y
+                value = chr(self.cells[y, x])
+                if index in on_path:
+                    value = f"\u001b[38;5;69m{value}\u001b[0m"
+                elif self.status[y, x] & CLOSED:
+                    value = f"\u001b[38;5;196m{value}\u001b[0m"
+                elif self.parent_idx[index] != -1:
+                    value = f"\u001b[38;5;118m{value}\u001b[0m"
+                ret += value
+            ret += "\n"
+        print("\033[2J")
+        print(ret)
+
+    def astar(self, start: Node, goal: Node, debug: bool = False) -> list[Node]:
         '''
         Returns the shortest path from start to goal using A* algorithm
+
+        With debug set the searched grid is printed before returning
         '''
         self.clear_nodes()
-        already_visited: set[Node] = set()
-        start.parent = None
-        start.cost = self.distance(start, goal)
-        to_visit: set[Node] = {start}
-        path: list[Node] = []
-        def debug():
-            ret = ""
-            for y in range(self.height):
-                for x in range(self.width):
-                    node = self[(x, y)]
-                    if node in path:
-                        node = f"\u001b[38;5;69m{node.value}\u001b[0m"
-                    elif node in already_visited:
-                        node = f"\u001b[38;5;196m{node.value}\u001b[0m"
-                    elif node in to_visit:
-                        node = f"\u001b[38;5;118m{node.value}\u001b[0m"
-                    else:
-                        node = node.value
-                    ret += node
-                ret += "\n"
-            print("\033[2J")
-            print(ret)
-            time.sleep(0.25)
-
-        visiting = start
-        while to_visit:
-            debug()
-            visiting = min(to_visit, key=lambda x: x.cost)
-            already_visited.add(visiting)
-            to_visit.remove(visiting)
-            if visiting == goal:
-                path.append(visiting)
-                node = visiting
-                while True:
-                    node = node.parent
-                    if node is None:
-                        break
-                    path.append(node)
-                    debug()
-                return list(reversed(path))
-            nodes = self.adjacent(visiting)
-            for node in nodes:
-                if not self.traversable(node):
-                    continue
-                if node in already_visited:
-                    continue
-                g_cost = self.distance(start, visiting) + self.distance(start, node)
-                h_cost = self.distance(goal, node)
-                cost = g_cost + h_cost
-                if node.cost < cost:
-                    continue
-                node.parent = visiting
-                node.cost = cost
-                to_visit.add(node)
-        return path
-
+        _astar_numba(
+            self.status.ravel(), self._precompute_heuristic(goal.x, goal.y),
+            self.cost_arr, self.parent_idx,
+            self.width, self.height, start.x, start.y, goal.x, goal.y,
+        )
+        path: list[int] = []
+        goal_index = goal.x + self.width * goal.y
+        if self.status[goal.y, goal.x] & CLOSED:
+            # jump points are joined by straight or diagonal lines,
+            # walk each of them back one index at a time
+            index = goal_index
+            while self.parent_idx[index] != -1:
+                previous = int(self.parent_idx[index])
+                x, y = index % self.width, index // self.width
+                px, py = previous % self.width, previous // self.width
+                dx, dy = (px > x) - (px < x), (py > y) - (py < y)
+                while index != previous:
+                    path.append(index)
+                    index += dx + self.width * dy
+            path.append(index)
+            path.reverse()
+        nodes = [self._node(index) for index in path]
+        if debug:
+            self._render_state(nodes)
+        return nodes
 
 
 data = '''
@@ -198,4 +447,4 @@ grid = Grid.from_text(data)
 
 A = grid[2, 8]
 B = grid[5, 1]
-grid.astar(A, B)
+grid.astar(A, B, debug=True)